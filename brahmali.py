@@ -1,16 +1,19 @@
 #!/bin/python3
 
 import argparse
-import json
+import io
 import os
 import re
 
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
 from pathlib import Path
 
 import bs4
 import joblib
 import requests
 import markdownify
+import orjson
 from vnmutils.paliutils import (
   pali_stem,
 )
@@ -25,7 +28,7 @@ SCIDMAP_FILE = ROOT_FOLDER.joinpath('scidmap.json')
 
 SC_API_URL = "https://suttacentral.net/api/publication/edition/pli-tv-vi-en-brahmali_scpub8-ed1-web_2022-02-10/files"
 
-CONTENT_TAGS = {
+CONTENT_TAGS = frozenset({
   None,
   'p',
   'ul',
@@ -36,22 +39,322 @@ CONTENT_TAGS = {
   'blockquote',
   'hr',
   'dd',
-}
+})
+
+_SANITIZE_TABLE = str.maketrans({
+  '\u00a0': ' ',
+  '\u2013': '-',
+  '\u2014': '-',
+  ':': None,
+  '.': None,
+  ',': None,
+  '/': ' ',
+  '"': '“',
+})
+_WS_RE = re.compile(r'\s+')
+_NONWORD_RE = re.compile(r'\W+')
 
 def sanitize_file_name(title: str) -> str:
-  return re.sub(
-    r'\s+', ' ',
-    title.replace('\u00a0', ' ').replace('\u2013', '-').replace('\u2014', '-').replace(':', '').replace('.', '').replace(',', '').replace("/", " ").replace("\"", "“")
-  ).strip()
-
-def sanitize_appendix_html(soup) -> str:
-  if not isinstance(soup, bs4.NavigableString):
-    # TODO: Find SC Vinaya links and replace them with internal links
-    # This will require running this script with the canon script
-    note_links = soup.find_all('a', attrs={'role': "doc-noteref"})
-    for note_link in note_links:
+  return _WS_RE.sub(' ', title.translate(_SANITIZE_TABLE)).strip()
+
+def strip_note_refs(soup, keep_in: list) -> None:
+  """Removes the note refs from a whole document, except inside `keep_in` tags."""
+  # Titles are read from those headings, so leave their text (and file names) be
+  # TODO: Find SC Vinaya links and replace them with internal links
+  # This will require running this script with the canon script
+  for note_link in soup.select('a[role="doc-noteref"]'):
+    if not note_link.find_parent(keep_in):
       note_link.decompose()
-  return str(soup)
+
+# markdownify reparses its input with bs4 and walks every node in Python.
+# The notes stick to a handful of simple tags, so those get converted in a
+# single regex pass that reproduces markdownify's output, falling back to
+# markdownify for anything this doesn't model.
+_HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>')
+_HTML_ATTR_RE = re.compile(r'''([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?''')
+_HTML_NEWLINE_WS_RE = re.compile(r'[\t \r\n]*[\r\n][\t \r\n]*')
+_HTML_SPACES_RE = re.compile(r'[\t ]+')
+_HTML_WS_RE = re.compile(r'[\t \r\n]+')
+_MD_NEWLINES_RE = re.compile(r'^(\n*)((?:.*[^\n])?)(\n*)$', re.DOTALL)
+
+# Leaf blocks: tag -> (prefix, newlines before, newlines after)
+MD_BLOCKS = {
+  'p': ('', 2, 2),
+  'h3': ('### ', 2, 2),
+  'h4': ('#### ', 2, 2),
+  'li': ('', 0, 1),
+  'dt': ('', 2, 1),
+  'dd': (':   ', 0, 1),
+}
+MD_LIST_ITEMS = {
+  'ul': {'li'},
+  'ol': {'li'},
+  'dl': {'dt', 'dd'},
+}
+MD_INLINE_MARKS = {
+  'i': '*',
+  'em': '*',
+  'b': '**',
+  'strong': '**',
+  'sup': '',
+  'sub': '',
+}
+MD_TRANSPARENT_TAGS = {'span', 'abbr', 'cite', 'small'}
+
+# Shared by every fallback conversion rather than rebuilt per section
+MARKDOWN_CONVERTER = markdownify.MarkdownConverter(
+  heading_style=markdownify.ATX,
+  strip=['script', 'style'],
+)
+
+class UnsupportedHTML(Exception):
+  pass
+
+def parse_html_attrs(attrs: str) -> dict:
+  parsed = dict()
+  for match in _HTML_ATTR_RE.finditer(attrs):
+    value = next((v for v in match.groups()[1:] if v is not None), '')
+    parsed[match.group(1).lower()] = unescape(value)
+  return parsed
+
+def join_md_children(children: list) -> str:
+  # Same as markdownify: where one child ends and the next starts with
+  # newlines, only the longer run (at most two) is kept
+  joined = ['']
+  for child in children:
+    if not child:
+      continue
+    leading, content, trailing = _MD_NEWLINES_RE.match(child).groups()
+    if joined[-1] and leading:
+      leading = '\n' * min(2, max(len(joined.pop()), len(leading)))
+    joined.extend([leading, content, trailing])
+  return ''.join(joined)
+
+def wrap_inline_md(tag: str, inner: str, attrs: str) -> str:
+  if tag in MD_TRANSPARENT_TAGS:
+    return inner
+  prefix = ' ' if inner.startswith(' ') else ''
+  suffix = ' ' if inner.endswith(' ') else ''
+  inner = inner.strip()
+  if not inner:
+    return ''
+  if tag != 'a':
+    mark = MD_INLINE_MARKS[tag]
+    return f"{prefix}{mark}{inner}{mark}{suffix}"
+  attrs = parse_html_attrs(attrs)
+  href = attrs.get('href')
+  title = attrs.get('title')
+  if inner.replace('\\_', '_') == href and not title:
+    return f"<{href}>"
+  if not href:
+    return inner
+  title = ' "%s"' % title.replace('"', '\\"') if title else ''
+  return f"{prefix}[{inner}]({href}{title}){suffix}"
+
+def join_md_blocks(blocks: list) -> str:
+  # Like markdownify, runs of newlines between blocks collapse to at most two
+  markdown = []
+  trailing = 0
+  for before, block, after in blocks:
+    markdown.append('\n' * min(2, max(trailing, before)))
+    markdown.append(block)
+    trailing = after
+  return ''.join(markdown)
+
+def simple_html_to_md(html: str) -> str:
+  """Converts HTML made of the tags above exactly as markdownify would.
+
+  Raises UnsupportedHTML for anything it doesn't model (nested lists, unknown
+  tags, ...)."""
+  blocks = [] # (newlines before, markdown, newlines after)
+  quotes = [] # the block lists of the enclosing blockquotes
+  lists = [] # [tag, next item number, items so far]
+  inline = [] # (tag, start index into text, attrs)
+  text = []
+  block = None
+  list_start = False
+  # markdownify only drops whitespace next to block tags, which neither <hr>
+  # nor the document edges are
+  after_hr = None # None at the start of the document
+  hr_gap = ''
+
+  def add_text(chunk: str):
+    nonlocal hr_gap
+    if not chunk:
+      return
+    if '<' in chunk:
+      raise UnsupportedHTML("Unrecognized markup")
+    chunk = _HTML_NEWLINE_WS_RE.sub('\n', unescape(chunk))
+    if block is None:
+      if chunk.strip():
+        raise UnsupportedHTML("Text outside of a block")
+      if after_hr is not False:
+        hr_gap = chunk
+      return
+    if not text and not inline and not chunk.strip():
+      # Whitespace-only first child (&nbsp; included)
+      return
+    chunk = _HTML_SPACES_RE.sub(' ', chunk)
+    text.append(chunk.replace('*', '\\*').replace('_', '\\_'))
+
+  def end_block():
+    content = join_md_children(text)
+    prefix, before, after = MD_BLOCKS[block]
+    if block == 'p':
+      content = content.strip(' \t\r\n')
+      if not content:
+        return None
+    else:
+      content = content.strip()
+      if not content:
+        raise UnsupportedHTML(f"Empty <{block}>")
+    if block in ('h3', 'h4', 'dt'):
+      content = _HTML_WS_RE.sub(' ', content)
+    if block == 'li':
+      if lists[-1][0] == 'ul':
+        prefix = '* '
+      else:
+        prefix = f"{lists[-1][1]}. "
+      lists[-1][1] += 1
+    if block in ('li', 'dd'):
+      indent = ' ' * len(prefix)
+      lines = content.split('\n')
+      content = '\n'.join([lines[0]] + [indent + line if line else '' for line in lines[1:]])
+    if lists:
+      lists[-1][2] += 1
+    return (before, prefix + content, after)
+
+  pos = 0
+  for match in _HTML_TAG_RE.finditer(html):
+    chunk = html[pos:match.start()]
+    add_text(chunk)
+    pos = match.end()
+    closing, name, attrs = match.group(1), match.group(2).lower(), match.group(3)
+    if name == 'hr' and hr_gap and (after_hr or hr_gap.strip('\n')):
+      raise UnsupportedHTML("Whitespace before an <hr>")
+    after_hr = name == 'hr'
+    hr_gap = ''
+    if name == 'br':
+      if block is None:
+        raise UnsupportedHTML("<br> outside of a block")
+      # markdownify renders headings inline, where a <br> is just a space
+      text.append(' ' if block in ('h3', 'h4') else '  \n')
+    elif name == 'hr':
+      if block is not None or lists:
+        raise UnsupportedHTML("<hr> inside a block or list")
+      blocks.append((2, '---', 2))
+    elif name == 'blockquote':
+      if block is not None or lists:
+        raise UnsupportedHTML("<blockquote> inside a block or list")
+      if not closing:
+        quotes.append(blocks)
+        blocks = []
+        continue
+      if not quotes:
+        raise UnsupportedHTML("Unbalanced </blockquote>")
+      quoted = join_md_blocks(blocks).strip(' \t\r\n')
+      if not quoted:
+        raise UnsupportedHTML("Empty <blockquote>")
+      quoted = '\n'.join('> ' + line if line else '>' for line in quoted.split('\n'))
+      blocks = quotes.pop()
+      blocks.append((1, quoted, 2))
+    elif name in MD_LIST_ITEMS:
+      if block is not None:
+        raise UnsupportedHTML(f"<{name}> inside <{block}>")
+      if not closing:
+        if lists:
+          raise UnsupportedHTML(f"Nested <{name}>")
+        start = parse_html_attrs(attrs).get('start', '') if name == 'ol' else ''
+        lists.append([name, int(start) if start.isdecimal() else 1, 0])
+        list_start = True
+        continue
+      if not lists or lists[-1][0] != name:
+        raise UnsupportedHTML(f"Unbalanced </{name}>")
+      if not lists.pop()[2]:
+        raise UnsupportedHTML(f"Empty <{name}>")
+      # The list is followed by a blank line
+      blocks[-1] = blocks[-1][:2] + (2,)
+    elif name in MD_BLOCKS:
+      if closing:
+        if block != name or inline:
+          raise UnsupportedHTML(f"Unbalanced </{name}>")
+        if chunk and text:
+          # markdownify fully strips the last child, &nbsp; included, unlike
+          # the block itself
+          text[-1] = text[-1].rstrip()
+        converted = end_block()
+        block = None
+        if converted:
+          if list_start:
+            # ...and preceded by one
+            converted = (2,) + converted[1:]
+            list_start = False
+          blocks.append(converted)
+        continue
+      if block is not None:
+        raise UnsupportedHTML(f"<{name}> inside <{block}>")
+      if name not in MD_LIST_ITEMS.get(lists[-1][0] if lists else None, {'p', 'h3', 'h4', 'dt', 'dd'}):
+        raise UnsupportedHTML(f"<{name}> in the wrong container")
+      block = name
+      text = []
+    elif name in MD_INLINE_MARKS or name in MD_TRANSPARENT_TAGS or name == 'a':
+      if block is None:
+        raise UnsupportedHTML(f"<{name}> outside of a block")
+      if closing:
+        if not inline or inline[-1][0] != name:
+          raise UnsupportedHTML(f"Unbalanced </{name}>")
+        tag, start, tag_attrs = inline.pop()
+        inner = join_md_children(text[start:])
+        del text[start:]
+        text.append(wrap_inline_md(tag, inner, tag_attrs))
+      else:
+        inline.append((name, len(text), attrs))
+    else:
+      raise UnsupportedHTML(f"Unsupported tag <{name}>")
+  add_text(html[pos:])
+  if block is not None or lists or quotes or inline:
+    raise UnsupportedHTML("Unclosed tags")
+  if hr_gap.strip('\n'):
+    raise UnsupportedHTML("Whitespace at the edge of the document")
+  return join_md_blocks(blocks).strip('\n')
+
+def html_to_md(html: str) -> str:
+  try:
+    return simple_html_to_md(html)
+  except UnsupportedHTML:
+    return MARKDOWN_CONVERTER.convert(html)
+
+def tags_to_md(tags: list) -> str:
+  try:
+    return simple_html_to_md(''.join(str(tag) for tag in tags))
+  except UnsupportedHTML:
+    # Hand markdownify the tags we already parsed rather than reparsing them
+    root = bs4.BeautifulSoup('', 'lxml')
+    for tag in tags:
+      root.append(tag)
+    return MARKDOWN_CONVERTER.convert_soup(root)
+
+class OutputWriter:
+  """Queues up output files so they can be written out in one batch."""
+  # Below this, a thread pool costs more than it saves
+  MIN_BATCH_SIZE = 4
+
+  def __init__(self):
+    # Keyed by path so that, as with direct writes, the last write to a
+    # file wins rather than racing in the pool
+    self.pending = dict()
+
+  def write_text(self, path: Path, text: str):
+    self.pending[path] = text
+
+  def flush(self):
+    pending, self.pending = self.pending, dict()
+    if len(pending) < self.MIN_BATCH_SIZE:
+      for path, text in pending.items():
+        path.write_text(text)
+      return
+    with ThreadPoolExecutor() as pool:
+      list(pool.map(Path.write_text, pending.keys(), pending.values()))
 
 class BaseEssayConfig:
   def __init__(self, folder):
@@ -66,8 +369,9 @@ class BaseEssayConfig:
       "https://suttacentral.net/edition/pli-tv-vi/en/brahmali/"
     ).replace(".html", "") + "?lang=en"
 
-  def generate_files(self, vinaya_essay: str) -> None:
-    pass
+  def generate_files(self, vinaya_essay: str, writer: OutputWriter) -> dict:
+    """Queues the essay's files and returns any new glossary entries."""
+    return dict()
 
 class SkipEssay(BaseEssayConfig):
   def __init__(self):
@@ -79,11 +383,11 @@ class ImportEssay(BaseEssayConfig):
     self.split_tag = split
 
   class FileWriteJob:
-    def __init__(self, path: Path, html: str, url: str, previous):
+    def __init__(self, path: Path, tags: list, url: str, previous):
       self.path = path
       self.url = url
       # HACK to fix https://github.com/suttacentral/bilara-data/pull/4279
-      self.markdown = markdownify.markdownify(html).replace(
+      self.markdown = tags_to_md(tags).replace(
         'https://suttacentral.nethttps://suttacentral.net',
         'https://suttacentral.net'
       )
@@ -96,19 +400,14 @@ class ImportEssay(BaseEssayConfig):
       self.next = next
       next.previous = self
     
-    def write_all(self):
-      if self.previous:
-        self.previous.write_all()
-      self.write()
-
-    def write(self):
+    def write(self, writer: OutputWriter):
       previous_link = ''
       next_link = ''
       if self.previous:
         previous_link = f"\n\nPrevious: [{self.previous.path.stem}](./{self.previous.path.name.replace(' ', '%20')})"
       if self.next:
         next_link = f"## Next section: [{self.next.path.stem}](./{self.next.path.name.replace(' ', '%20')})"
-      return self.path.write_text(f"""## By Ajahn Brahmali
+      writer.write_text(self.path, f"""## By Ajahn Brahmali
 
 Source: <{self.url}>{previous_link}
 
@@ -117,28 +416,39 @@ Source: <{self.url}>{previous_link}
 {next_link}
   """)
 
-  def generate_files(self, vinaya_essay: str) -> None:
+  def generate_files(self, vinaya_essay: str, writer: OutputWriter) -> dict:
+    first_job = None
     file_write_job = None
-    soup = bs4.BeautifulSoup(vinaya_essay, 'html.parser')
+    # Only build the <article>, skipping the page chrome but keeping the
+    # sibling structure we walk below intact
+    soup = bs4.BeautifulSoup(
+      vinaya_essay, 'lxml',
+      parse_only=bs4.SoupStrainer('article'),
+    )
+    strip_note_refs(soup, ['h1', self.split_tag])
     title = soup.find_all('h1')
     assert len(title) == 1, f"Found {len(title)} h1 tags"
     title = title[0].text
     url = self.url
     nav = soup.find_all('nav')
     if len(nav) == 1:
-      cur_elem = nav[0]
+      start_elem = nav[0]
     elif len(nav) == 0:
-      cur_elem = soup.find_all('h1')[0].next_sibling
+      # Start at the h1 itself; the walk below skips the whitespace after it
+      start_elem = soup.find_all('h1')[0]
     else:
       raise Exception(f"Found {len(nav)} nav tags")
     fname = sanitize_file_name(title)
     cur_file = self.folder.joinpath(f"{fname}.md")
-    html_content = ''
-    while cur_elem.next_sibling:
-      cur_elem = cur_elem.next_sibling
+    tags = []
+    # Only match tags (skipping whitespace) but don't filter by name, so
+    # unexpected tags still raise below
+    for cur_elem in start_elem.find_next_siblings(True):
       if cur_elem.name == self.split_tag:
-        file_write_job = ImportEssay.FileWriteJob(cur_file, html_content, url, file_write_job)
-        html_content = ''
+        file_write_job = ImportEssay.FileWriteJob(cur_file, tags, url, file_write_job)
+        if first_job is None:
+          first_job = file_write_job
+        tags = []
         title = cur_elem.text
         assert cur_elem.get('id'), f"Expected split tag {cur_elem} to have an id"
         url = self.url + f"#{cur_elem['id']}"
@@ -147,13 +457,17 @@ Source: <{self.url}>{previous_link}
         cur_file = self.folder.joinpath(f"{sanitize_file_name(title)}.md")
         continue
       if cur_elem.name in CONTENT_TAGS:
-        html_content += sanitize_appendix_html(cur_elem)
+        tags.append(cur_elem)
         continue
       if cur_elem.name == 'section' and cur_elem['role'] == "doc-endnotes":
         # TODO: Actually include the endnotes and bibliography somehow
         break
       raise Exception(f"Unexpected tag \"{cur_elem.name}\" found in \"{self.folder.stem}\"")
-    file_write_job.write_all()
+    file_write_job = first_job
+    while file_write_job:
+      file_write_job.write(writer)
+      file_write_job = file_write_job.next
+    return dict()
 
 PALI_ROOT_TO_GLOSSARY_ITEM = dict()
 
@@ -163,6 +477,16 @@ OTHER_WORD_FORMS = {
   'vibbham': ['vibbhant'],
   'dūs': ['dūsent', 'dūsess', 'dūsessant'],
 }
+# Glossary terms repeat the same few stems over and over.  A plain dict (not
+# functools.lru_cache) so that loky can pickle it along with the configs.
+_PALI_STEMS = dict()
+
+def cached_pali_stem(word: str) -> str:
+  if word not in _PALI_STEMS:
+    _PALI_STEMS[word] = pali_stem(word)
+  return _PALI_STEMS[word]
+
+_EXPANDED_FORMS = {root: [root] + alts for root, alts in OTHER_WORD_FORMS.items()}
 
 class ImportGlossary(BaseEssayConfig):
   def __init__(self, folder='Glosses', split="h3", linkto=False):
@@ -171,9 +495,14 @@ class ImportGlossary(BaseEssayConfig):
     self.MIN_CONTENT_LENGTH = 100
     self.linkto = linkto
   
-  def generate_files(self, vinaya_essay: str):
-    soup = bs4.BeautifulSoup(vinaya_essay, 'html.parser')
+  def generate_files(self, vinaya_essay: str, writer: OutputWriter) -> dict:
+    glossary = dict()
+    soup = bs4.BeautifulSoup(
+      vinaya_essay, 'lxml',
+      parse_only=bs4.SoupStrainer('article'),
+    )
     soup = soup.find('article')
+    strip_note_refs(soup, [self.split_tag])
     splits = soup.find_all(self.split_tag)
     for subhead in splits:
       pali_id = subhead.attrs['id']
@@ -193,31 +522,34 @@ class ImportGlossary(BaseEssayConfig):
         fname = sanitize_file_name(f"{pali_term} means {gloss}") + ".md"
       else:
         fname = sanitize_file_name(pali_term) + ".md"
-      content = ""
-      cur_elem = subhead.next_sibling
-      while cur_elem and cur_elem.name != self.split_tag and cur_elem.name != 'section':
+      buf = io.StringIO()
+      for cur_elem in subhead.next_siblings:
+        if cur_elem.name == self.split_tag or cur_elem.name == 'section':
+          break
         assert cur_elem.name in CONTENT_TAGS, f"Unexpected tag \"{cur_elem.name}\" found in under \"{pali_term}\" in {self.url}"
-        content += sanitize_appendix_html(cur_elem)
-        cur_elem = cur_elem.next_sibling
+        buf.write(str(cur_elem))
+      content = buf.getvalue()
       if len(content) < self.MIN_CONTENT_LENGTH:
         continue
       cur_file = self.folder.joinpath(fname)
       if self.linkto:  
-        for w in re.split(r'\W+', pali_term):
-          s = pali_stem(w)
-          PALI_ROOT_TO_GLOSSARY_ITEM[s] = str(cur_file)
-          if s in OTHER_WORD_FORMS:
-            for a in OTHER_WORD_FORMS[s]:
-              PALI_ROOT_TO_GLOSSARY_ITEM[a] = str(cur_file)
-      content = markdownify.markdownify(content)
+        cur_file_str = str(cur_file)
+        local_updates = dict()
+        for w in _NONWORD_RE.split(pali_term):
+          s = cached_pali_stem(w)
+          for k in _EXPANDED_FORMS.get(s, (s,)):
+            local_updates[k] = cur_file_str
+        glossary.update(local_updates)
+      content = html_to_md(content)
       if content.startswith(":   "):
         content = content[4:]
-      cur_file.write_text(f"""By Ajahn Brahmali
+      writer.write_text(cur_file, f"""By Ajahn Brahmali
 
 Source: <{self.url}#{pali_id}>
 
 {content}
 """)
+    return glossary
 
 ESSAY_CONFIGS = {
  './matter/foreword.html': SkipEssay(),
@@ -251,11 +583,40 @@ TITLE_OVERRIDES = {
 disk_memoizer = joblib.Memory(
   CACHE_FOLDER,
   verbose=0,
+  compress=('zlib', 3),
 )
 @disk_memoizer.cache()
 def get_vinaya_essays() -> dict:
   r = requests.get(SC_API_URL)
-  return r.json()
+  return orjson.loads(r.content)
+
+def process_essay(path: str, vinaya_essay: str, output_dir: Path) -> tuple:
+  # Runs in a worker process, so the glossary entries and the queued files
+  # come back as the return value for main() to merge in essay order
+  config = ESSAY_CONFIGS[path]
+  config.set_output_folder(output_dir)
+  config.folder.mkdir(parents=True, exist_ok=True)
+  writer = OutputWriter()
+  try:
+    glossary = config.generate_files(vinaya_essay, writer)
+    return glossary, writer.pending
+  except Exception as e:
+    print(f"ERROR Failed to generate {path}!")
+    raise e
+
+def process_essays(essays: list, output_dir: Path, n_jobs=-1) -> OutputWriter:
+  """Processes (path, html) pairs in parallel and merges their results."""
+  jobs = [
+    joblib.delayed(process_essay)(path, vinaya_essay, output_dir)
+    for path, vinaya_essay in essays
+  ]
+  # Parallel returns results in submission order, so when essays share a
+  # file (or a glossary stem) the later essay still wins
+  writer = OutputWriter()
+  for glossary, pending in joblib.Parallel(n_jobs=n_jobs, backend='loky')(jobs):
+    PALI_ROOT_TO_GLOSSARY_ITEM.update(glossary)
+    writer.pending.update(pending)
+  return writer
 
 def main(output_dir:Path=Path('./Ajahn Brahmali')):
   SCUID_SEGMENT_PATHS.load_data_from_json(
@@ -264,24 +625,20 @@ def main(output_dir:Path=Path('./Ajahn Brahmali')):
   )
   print("Generating Files from Ajahn Brahmali's Appendices...")
   vinaya_essays = get_vinaya_essays()
+  essays = []
   for path, vinaya_essay in vinaya_essays.items():
     if path not in ESSAY_CONFIGS:
       raise Exception(f"No config for {path}")
     if isinstance(ESSAY_CONFIGS[path], SkipEssay):
       continue
-    ESSAY_CONFIGS[path].set_output_folder(output_dir)
-    if not ESSAY_CONFIGS[path].folder.exists():
-      ESSAY_CONFIGS[path].folder.mkdir(parents=True)
-    try:
-      ESSAY_CONFIGS[path].generate_files(vinaya_essay)
-    except Exception as e:
-      print(f"ERROR Failed to generate {path}!")
-      raise e
+    essays.append((path, vinaya_essay))
+  process_essays(essays, output_dir).flush()
   print("  Done!")
 
-  ROOT_FOLDER.joinpath('glossary.json').write_text(
-    json.dumps(PALI_ROOT_TO_GLOSSARY_ITEM, indent=2)
-  )
+  ROOT_FOLDER.joinpath('glossary.json').write_bytes(orjson.dumps(
+    PALI_ROOT_TO_GLOSSARY_ITEM,
+    option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS,
+  ))
   print("  Wrote glossary.json to repo folder (regardless of output_dir)")
 
   rewrite_suttacentral_links_in_folder(output_dir)
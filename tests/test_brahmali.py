@@ -0,0 +1,183 @@
+import pytest
+
+import brahmali
+
+def make_essay(tmp_path, split="h2"):
+  config = brahmali.ImportEssay('Essay', split=split)
+  config.set_url('./matter/essay.html')
+  config.set_output_folder(tmp_path)
+  config.folder.mkdir()
+  return config
+
+def article(body: str) -> str:
+  return f"<html><body><header><p>chrome</p></header><article>\n{body}\n</article></body></html>"
+
+def test_essay_unexpected_tag_raises(tmp_path):
+  essay = make_essay(tmp_path)
+  html = article("""<h1>Title</h1>
+<h2 id="one">One</h2>
+<p>Text</p>
+<figure><table><tr><td>1</td></tr></table><figcaption><p>Caption</p></figcaption></figure>
+<h2 id="two">Two</h2>""")
+  with pytest.raises(Exception, match='Unexpected tag "figure"'):
+    essay.generate_files(html, brahmali.OutputWriter())
+
+NOTEREF = '<a href="#note-{0}" id="noteref-{0}" role="doc-noteref">{0}</a>'
+
+def test_essay_strips_note_refs_outside_titles(tmp_path):
+  essay = make_essay(tmp_path)
+  html = article(f"""<h1>Title{NOTEREF.format(1)}</h1>
+<p>Intro{NOTEREF.format(2)} text.</p>
+<h2 id="two">Second{NOTEREF.format(3)}</h2>
+<p>Body{NOTEREF.format(4)} text.</p>
+<h2 id="three">Third</h2>""")
+  writer = brahmali.OutputWriter()
+  essay.generate_files(html, writer)
+  # Titles keep their refs, so file names and links are the same as before
+  assert writer.pending == {
+    essay.folder / 'Title1.md': """## By Ajahn Brahmali
+
+Source: <https://suttacentral.net/edition/pli-tv-vi/en/brahmali/essay?lang=en>
+
+Intro text.
+
+## Next section: [Second3](./Second3.md)
+  """,
+    essay.folder / 'Second3.md': """## By Ajahn Brahmali
+
+Source: <https://suttacentral.net/edition/pli-tv-vi/en/brahmali/essay?lang=en#two>
+
+Previous: [Title1](./Title1.md)
+
+Body text.
+
+
+  """,
+  }
+
+def test_glossary_strips_note_refs_outside_terms(tmp_path):
+  glossary = brahmali.ImportGlossary()
+  glossary.set_url('./matter/appendix-terms.html')
+  glossary.set_output_folder(tmp_path)
+  body = "A body long enough that the glossary entry clears the minimum content length, even"
+  html = article(f"""<h3 id="pli-term"><i lang="pli">kaṭhina</i>{NOTEREF.format(1)} “robe-making”</h3>
+<p>{body}{NOTEREF.format(2)} once the ref is gone.</p>""")
+  writer = brahmali.OutputWriter()
+  glossary.generate_files(html, writer)
+  # The ref right after the term is the gloss, so stripping it would have
+  # renamed the file
+  assert writer.pending == {
+    glossary.folder / 'kaṭhina.md': f"""By Ajahn Brahmali
+
+Source: <https://suttacentral.net/edition/pli-tv-vi/en/brahmali/appendix-terms?lang=en#pli-term>
+
+{body} once the ref is gone.
+""",
+  }
+
+# The regex fast path has to match markdownify exactly wherever it doesn't
+# raise UnsupportedHTML
+SUPPORTED_HTML = [
+  '<p>Plain text.</p>',
+  '<p>One</p>\n<p>Two</p>',
+  '<p>  Leading and trailing  </p>',
+  '<p>Line one\nline two</p>',
+  '<p>Some <i lang="pli">dhamma</i> and <b>bold</b> and <em> spaced </em>text.</p>',
+  '<p><strong><i>both</i></strong> and <i></i>empty</p>',
+  '<p>snake_case and 2*3 &amp; &lt;tags&gt; and&nbsp;nbsp</p>',
+  '<p>See <a href="https://example.com/a_b">the link</a>.</p>',
+  '<p><a href="https://example.com/a_b">https://example.com/a_b</a></p>',
+  '<p><a href="https://example.com" title="A &quot;T&quot;">titled</a></p>',
+  '<p><a href="https://example.com" title="T">https://example.com</a></p>',
+  '<p><a>no href</a> and <a href="">empty href</a></p>',
+  '<p>Note<sup>1</sup> and H<sub>2</sub>O in <span class="x">a span</span>.</p>',
+  '<p><i>a</i>\n<span>\nb</span></p>',
+  '<p>Line<br/>break and <br/>\nanother</p>',
+  '<p><br/>Leading break</p>',
+  '<h3 id="x">Split<br/>heading</h3>\n<h4><i>Split<br/></i>heading</h4>',
+  '<dl><dt>Split<br/>\nterm</dt><dd>Split<br/>definition</dd></dl>',
+  '<ul><li>Split<br/>\nitem</li><li>Next</li></ul>',
+  '<ol start="9"><li>Nine<br/>lines</li><li>Ten</li></ol>',
+  '<blockquote><p>Quoted<br/>break</p><dd>Quoted<br/>definition</dd></blockquote>',
+  '<p></p><p>After an empty paragraph</p>',
+  '<h3 id="x">Heading <i>three</i></h3>\n<p>Body</p>\n<h4>Heading\nfour</h4>',
+  '<ul>\n<li>one</li>\n<li>two\nlines</li>\n</ul>',
+  '<ol>\n<li>one</li>\n<li>two</li>\n</ol>',
+  '<ol start="5">\n<li>five</li>\n<li>six</li>\n</ol>',
+  '<ol start="x"><li>one</li></ol>',
+  '<p>Before</p><ul><li>a</li></ul><p>After</p>',
+  '<ul><li>a</li></ul><ol><li>b</li></ol>',
+  '<dl>\n<dt>Term</dt>\n<dd>Definition\nover lines</dd>\n<dd>Another</dd>\n<dt>Second\nterm</dt>\n<dd>Def</dd>\n</dl>',
+  '<dd>A bare definition as in the glossary appendices</dd>\n<p>More</p>',
+  '<p>Para</p>\n<dd>Definition after a paragraph</dd>',
+  '<blockquote>\n<p>Quoted one</p>\n<p>Quoted two</p>\n</blockquote>',
+  '<blockquote><p>a</p></blockquote>\n<blockquote><p>b</p></blockquote>',
+  '<blockquote><p>q</p><hr/><p>r</p></blockquote>',
+  '<blockquote><p>Outer</p><blockquote><p>Inner</p></blockquote></blockquote>',
+  '<blockquote><ul><li>quoted item</li></ul><p>After</p></blockquote>',
+  '<dd>Before a quote</dd><blockquote><p>q</p></blockquote>',
+  '<p>Rule</p>\n<hr/>\n<p>After</p>',
+  '<p>x&nbsp;</p>',
+  '<p>&nbsp;<i>x</i></p>',
+  '<p>&nbsp;x</p>',
+  '<p><i>x</i>&nbsp;</p>',
+  '<p><span>x&nbsp;</span></p>',
+  '<p>&nbsp;</p><p>b</p>',
+  '<p>a</p>&nbsp;<p>b</p>',
+  '<blockquote><p>x&nbsp;</p></blockquote>',
+  '<ul><li>&nbsp;x&nbsp;</li></ul>',
+  '<h3>&nbsp;a&nbsp;</h3>',
+  '<hr/><hr/>',
+  '\n<hr/>\n',
+]
+
+UNSUPPORTED_HTML = [
+  '<div>Unknown tag</div>',
+  '<ul><li>Outer<ul><li>Nested</li></ul></li></ul>',
+  '<ul><li><p>Paragraph in item</p></li></ul>',
+  '<p>Unclosed',
+  'Bare text',
+  '<li>Item outside a list</li>',
+  '<ul><li></li></ul>',
+  '<p>a <!-- comment --> b</p>',
+  '<hr/>\n<hr/>',
+  '<blockquote><hr/>\n<hr/></blockquote>',
+  '&nbsp;<hr/>',
+  '<hr/> ',
+]
+
+@pytest.mark.parametrize('html', SUPPORTED_HTML)
+def test_simple_html_to_md_matches_markdownify(html):
+  assert brahmali.simple_html_to_md(html) == brahmali.MARKDOWN_CONVERTER.convert(html)
+
+@pytest.mark.parametrize('html', UNSUPPORTED_HTML)
+def test_simple_html_to_md_rejects_unmodeled_html(html):
+  with pytest.raises(brahmali.UnsupportedHTML):
+    brahmali.simple_html_to_md(html)
+  assert brahmali.html_to_md(html) == brahmali.MARKDOWN_CONVERTER.convert(html)
+
+def glossary_entry(term: str, gloss: str, body: str) -> str:
+  return f"""<h3 id="{term}"><i lang="pli">{term}</i> {gloss}</h3>
+<p>{body} The rest of this sentence is only here to pad the entry past the minimum content length.</p>
+"""
+
+def test_later_essay_wins_shared_outputs(tmp_path, monkeypatch):
+  monkeypatch.setattr(brahmali, 'PALI_ROOT_TO_GLOSSARY_ITEM', dict())
+  path = './matter/appendix-terms.html'
+  first = article(glossary_entry('kaṭhina', '“frame”', 'First.') + glossary_entry('vassa', 'rains', 'First.'))
+  second = article(glossary_entry('kaṭhina', '“robe-making”', 'Second.') + glossary_entry('vassa', 'rains', 'Second.'))
+  # Two workers, so the results really do go through loky
+  writer = brahmali.process_essays([(path, first), (path, second)], tmp_path, n_jobs=2)
+  folder = tmp_path / 'Glosses'
+  assert set(writer.pending) == {
+    folder / 'kaṭhina means “frame”.md',
+    folder / 'kaṭhina means “robe-making”.md',
+    folder / 'vassa.md',
+  }
+  assert 'Second.' in writer.pending[folder / 'vassa.md']
+  # Both essays map the same stems; the second one's file wins
+  assert brahmali.PALI_ROOT_TO_GLOSSARY_ITEM
+  assert set(brahmali.PALI_ROOT_TO_GLOSSARY_ITEM.values()) == {
+    str(folder / 'kaṭhina means “robe-making”.md'),
+    str(folder / 'vassa.md'),
+  }